@@ -34,21 +34,32 @@ The script will do the following steps:
 from __future__ import unicode_literals, print_function
 
 import argparse
+import io
+import json
 import os
 import re
 import subprocess
 import sys
-import tempfile
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import requests
+from build import ProjectBuilder
 from git import Repo, BadName, GitCommandError
 from git.cmd import Git
 from github_release import gh_release_create
+from packaging.utils import (
+    InvalidSdistFilename, InvalidWheelFilename, parse_sdist_filename, parse_wheel_filename
+)
+from twine.commands.upload import upload as twine_upload
+from twine.exceptions import TwineException
+from twine.settings import Settings
 
 # Magical, always present, empty tree reference
 # https://stackoverflow.com/questions/9765453/
 THE_NULL_COMMIT = Git().hash_object(os.devnull, t="tree")
 
-ISSUE_NUMBER = re.compile(r"#(\d+)")
+ISSUE_NUMBER = re.compile(r"#(\d+)", re.ASCII)
 
 CHANGELOG_HEADER = """
 Changes since last version
@@ -62,19 +73,25 @@ class Formatter(argparse.RawDescriptionHelpFormatter, argparse.ArgumentDefaultsH
 
 
 class Repository(object):
-    RELEASE_TAG_PATTERN = re.compile(r"^v\d+(\.\d+){0,2}$")
+    RELEASE_TAG_PATTERN = re.compile(r"^v\d+(\.\d+){0,2}$", re.ASCII)
 
     def __init__(self, options):
         self.repo = Repo(options.directory)
         self._force = options.force
         self._current_tag = None
+        self._dirty = None
+        self._untracked = None
+        self._cache_file = None
+        self._cache = self._load_cache()
 
     @property
     def current_tag(self):
         if self._current_tag:
             return self._current_tag
         try:
-            current_name = self.repo.git.describe(all=True)
+            current_name = self._tag_from_environment()
+            if current_name is None:
+                current_name = self.repo.git.describe(all=True)
             self._current_tag = self.repo.rev_parse(current_name)
             return self._current_tag
         except (BadName, GitCommandError):
@@ -96,37 +113,102 @@ class Repository(object):
         """
         if self._force:
             return True
-        if self.repo.is_dirty():
-            print("Repository is dirty", file=sys.stderr)
-            return False
-        if self.repo.untracked_files:
-            file_list = "\n\t".join(self.repo.untracked_files)
-            print("Repository has untracked files:\n\t{}".format(file_list), file=sys.stderr)
-            return False
+        # Check the tag first, so non-release commits bail out before forking git status
         if not self.current_tag:
             print("No tag found")
             return False
         try:
-            valid_tag = self.RELEASE_TAG_PATTERN.match(self.current_tag.tag) is not None
-            if not valid_tag:
+            if not self.RELEASE_TAG_PATTERN.match(self.current_tag.tag):
                 print("Tag {} is not a valid release tag".format(self.current_tag.tag))
-            return valid_tag
+                return False
         except AttributeError:
             print("Unable to read tag name")
             return False
+        self._probe()
+        if self._dirty:
+            print("Repository is dirty", file=sys.stderr)
+            return False
+        if self._untracked:
+            file_list = "\n\t".join(self._untracked)
+            print("Repository has untracked files:\n\t{}".format(file_list), file=sys.stderr)
+            return False
+        return True
+
+    def _tag_from_environment(self):
+        """Return the release tag named by the CI environment, if any
+
+        When the build was triggered by a tag, CI systems already tell us its name,
+        so there is no need to walk the refs with git describe to rediscover it.
+        """
+        ref = os.environ.get("GITHUB_REF_NAME") or os.environ.get("CI_COMMIT_TAG")
+        if ref and self.RELEASE_TAG_PATTERN.match(ref):
+            return ref
+        return None
+
+    def _load_cache(self):
+        """Load cached git lookups from a previous run on the same HEAD
+
+        The cache file is keyed by the HEAD commit, so moving HEAD invalidates it
+        automatically. Caching is best effort, and failures simply mean an empty cache.
+        """
+        try:
+            head_oid = self.repo.head.commit.hexsha
+            self._cache_file = os.path.join(self.repo.common_dir, "publish-cache-{}.json".format(head_oid))
+            with open(self._cache_file, encoding="utf-8") as fobj:
+                return json.load(fobj)
+        except (OSError, TypeError, ValueError):
+            return {}
+
+    def _save_cache(self):
+        if not self._cache_file:
+            return
+        try:
+            with open(self._cache_file, "w", encoding="utf-8") as fobj:
+                json.dump(self._cache, fobj)
+        except OSError:
+            pass
+
+    def _probe(self):
+        """Find dirty state and untracked files with a single git call
+
+        `is_dirty()` and `untracked_files` each fork their own git process, so
+        run `git status --porcelain=v2 --branch` once and parse the output instead.
+        """
+        if self._dirty is not None:
+            return
+        output = self.repo.git.status(porcelain="v2", branch=True, untracked_files="normal")
+        self._dirty = False
+        self._untracked = []
+        for line in output.splitlines():
+            if line.startswith(("1 ", "2 ", "u ")):
+                self._dirty = True
+            elif line.startswith("? "):
+                self._untracked.append(line[2:])
 
     def generate_changelog(self):
         """Use the git log to create a changelog with all changes since the previous tag"""
-        try:
-            previous_name = self.repo.git.describe("{}^".format(self.current_tag), abbrev=0)
-            previous_tag = self.repo.rev_parse(previous_name)
-        except GitCommandError:
-            previous_tag = THE_NULL_COMMIT
+        previous_tag = self._previous_tag()
         current = self._resolve_tag(self.current_tag)
         previous = self._resolve_tag(previous_tag)
         commit_range = "{}..{}".format(previous, current)
-        return [(self._shorten(commit.hexsha), commit.summary) for commit in self.repo.iter_commits(commit_range)
-                if len(commit.parents) <= 1]
+        raw = self.repo.git.log(commit_range, no_merges=True, pretty="format:%h%x1f%s")
+        return [tuple(line.split("\x1f", 1)) for line in raw.splitlines() if line]
+
+    def _previous_tag(self):
+        """Find the tag before the current one, trying the cache first"""
+        cached_name = self._cache.get("previous_tag")
+        if cached_name is not None:
+            try:
+                return self.repo.rev_parse(cached_name)
+            except (BadName, GitCommandError):
+                pass  # stale cache entry, fall through and ask git
+        try:
+            previous_name = self.repo.git.describe("{}^".format(self.current_tag), abbrev=0)
+            self._cache["previous_tag"] = previous_name
+            self._save_cache()
+            return self.repo.rev_parse(previous_name)
+        except (BadName, GitCommandError):
+            return THE_NULL_COMMIT
 
     @staticmethod
     def _resolve_tag(tag):
@@ -136,9 +218,6 @@ class Repository(object):
             current = tag
         return current
 
-    def _shorten(self, sha):
-        return self.repo.git.rev_parse(sha, short=True)
-
 
 class Uploader(object):
     def __init__(self, options, version, changelog, artifacts):
@@ -147,58 +226,109 @@ class Uploader(object):
         self.version = version
         self.changelog = changelog
         self.artifacts = artifacts
+        self._force = options.force
 
-    def _call(self, *args, **kwargs):
-        msg = kwargs.pop("msg", "")
-        if kwargs:
-            raise TypeError("Unexpected **kwargs: {!r}".format(kwargs))
+    @staticmethod
+    def _already_released(url):
+        """Return True if the given API URL confirms an existing release
+
+        One cheap GET up front is much faster than uploading every artifact
+        just to have the server reject it as a duplicate.
+        """
         try:
-            if self.dry_run:
-                cmd_line = " ".join(repr(x) for x in args)
-                print("Dry run. Would have called: {}".format(cmd_line))
-            else:
-                subprocess.check_call(args)
-        except subprocess.CalledProcessError:
-            print(msg, file=sys.stderr)
-            raise
+            with urllib.request.urlopen(url, timeout=3) as response:
+                return response.status == 200
+        except OSError:
+            return False
+
+    def _package_name(self):
+        """Derive the PyPI package name from the artifact filenames"""
+        for artifact in self.artifacts:
+            filename = os.path.basename(artifact)
+            try:
+                if filename.endswith(".whl"):
+                    return parse_wheel_filename(filename)[0]
+                if filename.endswith(".tar.gz"):
+                    return parse_sdist_filename(filename)[0]
+            except (InvalidSdistFilename, InvalidWheelFilename):
+                continue
+        return None
 
     def github_release(self):
         """Create release in github, and upload artifacts and changelog"""
+        if not self.dry_run and not self._force:
+            url = "https://api.github.com/repos/{repo}/releases/tags/{tag}".format(repo=self.repo, tag=self.version)
+            if self._already_released(url):
+                print("Github release {} already exists, skipping".format(self.version))
+                return
         gh_release_create(
             self.repo, self.version, self.artifacts,
             body=format_gh_changelog(self.changelog), publish=True, dry_run=self.dry_run
         )
 
     def pypi_release(self):
-        """Create release in pypi.python.org, and upload artifacts and changelog"""
-        self._call("twine", "upload", *self.artifacts, msg="Failed to upload artifacts to PyPI")
+        """Create release in pypi.python.org, and upload artifacts and changelog
+
+        Calling twine in-process keeps one requests session alive for all artifacts,
+        instead of a fresh TLS handshake and authentication per invocation.
+        """
+        if self.dry_run:
+            artifact_list = " ".join(self.artifacts)
+            print("Dry run. Would have uploaded to PyPI: {}".format(artifact_list))
+            return
+        # The probe only knows about pypi.org, so it must not veto uploads
+        # that are configured to go to another index
+        custom_index = os.environ.get("TWINE_REPOSITORY_URL") or os.environ.get("TWINE_REPOSITORY")
+        package = None if self._force or custom_index else self._package_name()
+        if package:
+            url = "https://pypi.org/pypi/{package}/{version}/json".format(
+                package=package, version=self.version.removeprefix("v"))
+            if self._already_released(url):
+                print("PyPI release {} already exists, skipping".format(self.version))
+                return
+        # The TWINE_* variables are only read by twine's CLI layer, so pass
+        # them on explicitly to keep the old subprocess behaviour
+        settings = Settings(
+            repository_name=os.environ.get("TWINE_REPOSITORY", "pypi"),
+            repository_url=os.environ.get("TWINE_REPOSITORY_URL"),
+            username=os.environ.get("TWINE_USERNAME"),
+            password=os.environ.get("TWINE_PASSWORD"),
+            non_interactive=True,
+        )
+        try:
+            twine_upload(settings, self.artifacts)
+        except (TwineException, requests.RequestException):
+            print("Failed to upload artifacts to PyPI", file=sys.stderr)
+            raise
 
 
 def format_rst_changelog(changelog, options):
-    output = CHANGELOG_HEADER.splitlines(False)
+    output = io.StringIO()
+    output.write(CHANGELOG_HEADER)
     links = {}
+    base_url = "https://github.com/{org}/{repo}".format(org=options.organization, repo=options.repository)
+
+    def _link_issue(match):
+        issue_number = match.group(1)
+        links[issue_number] = ".. _#{num}: {base}/issues/{num}".format(num=issue_number, base=base_url)
+        return "`#{num}`_".format(num=issue_number)
+
     for sha, summary in changelog:
-        links[sha] = ".. _{sha}: https://github.com/{org}/{repo}/commit/{sha}".format(
-            sha=sha, org=options.organization, repo=options.repository)
-        for match in ISSUE_NUMBER.finditer(summary):
-            issue_number = match.group(1)
-            links[issue_number] = ".. _#{num}: https://github.com/{org}/{repo}/issues/{num}".format(
-                num=issue_number, org=options.organization, repo=options.repository)
-        summary = ISSUE_NUMBER.sub(r"`#\1`_", summary)
-        output.append("* `{sha}`_: {summary}".format(sha=sha, summary=summary))
-    output.append("")
-    output.extend(links.values())
-    return "\n".join(output)
+        links[sha] = ".. _{sha}: {base}/commit/{sha}".format(sha=sha, base=base_url)
+        summary = ISSUE_NUMBER.sub(_link_issue, summary)
+        output.write("* `{sha}`_: {summary}\n".format(sha=sha, summary=summary))
+    if links:
+        output.write("\n")
+        output.write("\n".join(links.values()))
+    return output.getvalue()
 
 
 def format_gh_changelog(changelog):
-    output = CHANGELOG_HEADER.splitlines(False)
-    links = {}
+    output = io.StringIO()
+    output.write(CHANGELOG_HEADER)
     for sha, summary in changelog:
-        output.append("* {sha}: {summary}".format(sha=sha, summary=summary))
-    output.append("")
-    output.extend(links.values())
-    return "\n".join(output)
+        output.write("* {sha}: {summary}\n".format(sha=sha, summary=summary))
+    return output.getvalue()
 
 
 def create_artifacts(changelog, options):
@@ -206,18 +336,18 @@ def create_artifacts(changelog, options):
 
     Wheels and tarballs
     """
-    fd, name = tempfile.mkstemp(prefix="changelog", suffix=".rst", text=True)
-    formatted_changelog = format_rst_changelog(changelog, options)
-    with open(fd, "w", encoding="utf-8") as fobj:
-        fobj.write(formatted_changelog)
-    subprocess.check_call([
-        sys.executable, "setup.py",
-        "egg_info", "--tag-build=",
-        "sdist",
-        "bdist_wheel", "--universal"
-    ], env={"CHANGELOG_FILE": name})
-    os.unlink(name)
-    return [os.path.abspath(os.path.join("dist", fname)) for fname in os.listdir("dist")]
+    os.environ["CHANGELOG_CONTENT"] = format_rst_changelog(changelog, options)
+    try:
+        builder = ProjectBuilder(os.getcwd())
+        # Keep the old setup.py behaviour: reset any tag_build from setup.cfg,
+        # and tag wheels as universal. distutils applies command options from
+        # anywhere on the command line, so these ride along as build options.
+        builder.build("sdist", "dist", config_settings={"--build-option": ["egg_info", "--tag-build="]})
+        builder.build("wheel", "dist", config_settings={"--build-option": ["--universal", "egg_info", "--tag-build="]})
+    finally:
+        del os.environ["CHANGELOG_CONTENT"]
+    dist_dir = os.path.abspath("dist")
+    return [os.path.join(dist_dir, entry.name) for entry in os.scandir(dist_dir) if entry.is_file()]
 
 
 def publish(options):
@@ -229,11 +359,15 @@ def publish(options):
     artifacts = create_artifacts(changelog, options)
     uploader = Uploader(options, repo.version, changelog, artifacts)
     return_code = 0
-    for i, release in enumerate((uploader.github_release, uploader.pypi_release)):
-        try:
-            release()
-        except subprocess.CalledProcessError:
-            return_code |= pow(2, i)
+    # The two releases talk to independent endpoints, so run them concurrently
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = {executor.submit(release): i
+                   for i, release in enumerate((uploader.github_release, uploader.pypi_release))}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except (subprocess.CalledProcessError, TwineException, requests.RequestException):
+                return_code |= 1 << futures[future]
     return return_code
 
 
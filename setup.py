@@ -19,8 +19,13 @@
 import os
 from setuptools import setup
 
+HERE = os.path.dirname(os.path.abspath(__file__))
+
 GENERIC_REQ = [
     'GitPython==3.1.41',
+    "build==1.2.2",
+    "packaging==24.1",
+    "requests==2.32.3",
     "twine==5.1.1",
     "githubrelease==1.5.9",
 ]
@@ -40,21 +45,25 @@ TESTS_REQ = [
 
 def _generate_description():
     description = [_read("README.rst")]
-    changelog_file = os.getenv("CHANGELOG_FILE")
-    if changelog_file:
-        description.append(_read(changelog_file))
+    changelog = os.getenv("CHANGELOG_CONTENT")
+    if changelog:
+        description.append(changelog)
+    else:
+        changelog_file = os.getenv("CHANGELOG_FILE")
+        if changelog_file:
+            description.append(_read(changelog_file))
     return "\n".join(description)
 
 
 def _get_license_name():
-    with open(os.path.join(os.path.dirname(__file__), "LICENSE")) as f:
+    with open(os.path.join(HERE, "LICENSE")) as f:
         for line in f:
             if line.strip():
                 return line.strip()
 
 
 def _read(filename):
-    with open(os.path.join(os.path.dirname(__file__), filename)) as f:
+    with open(os.path.join(HERE, filename)) as f:
         return f.read()
 
 
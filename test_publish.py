@@ -36,7 +36,25 @@ def _pad(prefix):
     return prefix + "0" * (40 - len(prefix))
 
 
+def _status_output(dirty, untracked):
+    lines = [
+        "# branch.oid {}".format(_pad("333333")),
+        "# branch.head master"
+    ]
+    if dirty:
+        lines.append("1 .M N... 100644 100644 100644 {sha} {sha} publish.py".format(sha=_pad("333333")))
+    if untracked:
+        lines.append("? a")
+    return "\n".join(lines)
+
+
 class TestRepository(object):
+    @pytest.fixture(autouse=True)
+    def clean_environment(self, monkeypatch):
+        """Keep ambient CI variables from short-circuiting the tag lookup"""
+        monkeypatch.delenv("GITHUB_REF_NAME", raising=False)
+        monkeypatch.delenv("CI_COMMIT_TAG", raising=False)
+
     @pytest.fixture
     def options(self):
         return argparse.Namespace(directory=".", dry_run=True, force=False)
@@ -49,14 +67,14 @@ class TestRepository(object):
                 Commit(mock_repo, _h2b("222222"), message="Second commit", parents=("111111",)),
                 Commit(mock_repo, _h2b("333333"), message="Third commit", parents=("222222",))
             ]
-            mock_repo.iter_commits.return_value = commits
+            mock_repo.git.log.return_value = "\n".join(
+                "{}\x1f{}".format(commit.hexsha[:7], commit.summary) for commit in commits)
             rev_parse_returns = {
                 "heads/master": commits[-1],
                 PREVIOUS_TAG: TagObject(mock_repo, _h2b("aaaaaa"), object=commits[-2], tag=PREVIOUS_TAG),
                 CURRENT_TAG: TagObject(mock_repo, _h2b("bbbbbb"), object=commits[-1], tag=CURRENT_TAG)
             }
             mock_repo.rev_parse.side_effect = lambda x: rev_parse_returns[x]
-            mock_repo.git.rev_parse.side_effect = lambda x, **kwargs: x
 
             def describe(rev=None, **kwargs):
                 print("call to describe(%r, %r)" % (rev, kwargs))
@@ -84,8 +102,7 @@ class TestRepository(object):
         (False, False, True)
     ))
     def test_can_not_release_from_unclean_repo(self, repository, git_repo, dirty, untracked, result):
-        git_repo.is_dirty.return_value = dirty
-        git_repo.untracked_files = ["a"] if untracked else []
+        git_repo.git.status.return_value = _status_output(dirty, untracked)
 
         assert repository.ready_for_release() is result
 
@@ -99,8 +116,7 @@ class TestRepository(object):
         ("v1.a.3", False),
     ))
     def test_tag_must_match_version(self, repository, git_repo, name, result):
-        git_repo.is_dirty.return_value = False
-        git_repo.untracked_files = []
+        git_repo.git.status.return_value = _status_output(dirty=False, untracked=False)
         git_repo.head.commit = "123"
         mock_tag = mock.MagicMock()
         mock_tag.tag = name
@@ -109,6 +125,12 @@ class TestRepository(object):
 
         assert repository.ready_for_release() is result
 
+    def test_takes_tag_from_environment(self, monkeypatch, repository, git_repo):
+        monkeypatch.setenv("GITHUB_REF_NAME", CURRENT_TAG)
+
+        assert repository.current_tag.tag == CURRENT_TAG
+        git_repo.git.describe.assert_not_called()
+
     @pytest.mark.parametrize("current_tag,previous_tag", (
         ("444444", publish.THE_NULL_COMMIT),
         ("v1.2.3", "v1.2.2")
@@ -118,8 +140,9 @@ class TestRepository(object):
         changelog = repository.generate_changelog()
 
         assert len(changelog) == 3
-        assert changelog[0] == (_pad("111111"), "First commit")
-        assert changelog[1] == (_pad("222222"), "Second commit")
-        assert changelog[2] == (_pad("333333"), "Third commit")
+        assert changelog[0] == (_pad("111111")[:7], "First commit")
+        assert changelog[1] == (_pad("222222")[:7], "Second commit")
+        assert changelog[2] == (_pad("333333")[:7], "Third commit")
 
-        git_repo.iter_commits.assert_called_with("{}..{}".format(previous_tag, current_tag))
+        git_repo.git.log.assert_called_with(
+            "{}..{}".format(previous_tag, current_tag), no_merges=True, pretty="format:%h%x1f%s")